@@ -6,8 +6,17 @@ Gunicorn Uvicorn config to launch in Digital Ocean's App Platform.
 Using their Flask template: https://github.com/digitalocean/sample-flask
 
 """
+import multiprocessing
+import os
 
 bind = "0.0.0.0:8080"
-workers = 4
+# cpu_count() reports host CPUs inside containers and each worker opens its own
+# MongoDB connection pool, so cap the default and allow an override
+workers = int(os.environ.get("WEB_CONCURRENCY", min(multiprocessing.cpu_count(), 4)))
+# Motor runs PyMongo calls on a thread pool; one thread per worker avoids GIL
+# contention, so scale with worker processes instead. Each worker then runs one
+# database operation at a time (a slow export or aggregation holds up that
+# worker's other requests) and src/app.py sizes its connection pool to match
+raw_env = ["MOTOR_MAX_WORKERS=1"]
 # Using Uvicorn's Gunicorn worker class
 worker_class = "uvicorn.workers.UvicornWorker"
@@ -1,19 +1,29 @@
+import asyncio
+import csv
 import io
 import logging
+from contextlib import asynccontextmanager
 from datetime import date
 from pathlib import Path
+from typing import Any, AsyncIterator
 
-import boto3
-import pandas as pd
+import aioboto3
+from async_lru import alru_cache
 from botocore.exceptions import NoCredentialsError
 from decouple import config
 from fastapi import FastAPI, File, Form, HTTPException, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from motor.motor_asyncio import AsyncIOMotorClient
-from odmantic import AIOEngine
+from odmantic import AIOEngine, query
+from pymongo import ReturnDocument
 
 from .data import (
+    ATTENDANCE_PIPELINE,
+    DOC_KEYS,
+    FIELDS,
+    IS_COUPLE_STAGE,
+    TOTALS_STAGE,
     DietaryRequirementsRequest,
     MusicResponse,
     ParkingRequiredRequest,
@@ -26,12 +36,48 @@ from .data import (
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-client = AsyncIOMotorClient(config("MONGO_URI", default="mongodb://localhost:27017/"))
+# Motor runs each operation on one of MOTOR_MAX_WORKERS executor threads, so
+# pooled connections beyond that would only hold idle sockets
+max_pool_size = config("MOTOR_MAX_WORKERS", default=20, cast=int)
+client = AsyncIOMotorClient(
+    config("MONGO_URI", default="mongodb://localhost:27017/"),
+    minPoolSize=min(5, max_pool_size),
+    maxPoolSize=max_pool_size,
+    maxIdleTimeMS=60000,
+)
 engine = AIOEngine(client=client, database=config("MONGO_DB_NAME", default="test"))
 
 templates_dir = Path(__file__).parent / "templates"
 
-app = FastAPI()
+s3_session = aioboto3.Session()
+
+
+async def backfill_derived_fields() -> None:
+    # Only documents written before is_couple and the stored totals existed
+    # are touched, so restarts don't rewrite the whole collection
+    await engine.get_collection(WeddingGuestGroup).update_many(
+        {
+            "$or": [
+                {"is_couple": {"$exists": False}},
+                {"party_total": {"$exists": False}},
+                {"ceremony_total": {"$exists": False}},
+            ]
+        },
+        [IS_COUPLE_STAGE, TOTALS_STAGE],
+    )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    await client.admin.command("ping")
+    await engine.configure_database([WeddingGuestGroup])
+    await backfill_derived_fields()
+    async with s3_session.client("s3") as s3:
+        app.state.s3 = s3
+        yield
+
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 origins = [
     "http://localhost:5173",
@@ -60,9 +106,41 @@ async def fetch_guest_group(code: str) -> WeddingGuestGroup:
     return guest_group
 
 
+# Codes only change on a database upload, which clears the cache on its own
+# worker only, so keep the TTL short; anything returning guest data or
+# writing to S3 must read from the database.
+@alru_cache(maxsize=512, ttl=5)
+async def check_code_exists(code: str) -> bool:
+    guest_group = await engine.get_collection(WeddingGuestGroup).find_one(
+        {"code": code}, {"_id": 1}
+    )
+    if not guest_group:
+        raise HTTPException(status_code=404, detail="Invalid user code, please login")
+    return True
+
+
+async def update_guest_group(code: str, update: dict | list) -> WeddingGuestGroup:
+    doc = await engine.get_collection(WeddingGuestGroup).find_one_and_update(
+        {"code": code}, update, return_document=ReturnDocument.AFTER
+    )
+    if not doc:
+        raise HTTPException(status_code=404, detail="Invalid user code, please login")
+    return WeddingGuestGroup.model_validate_doc(doc)
+
+
+# Short TTL: another worker may have replaced the admin code via an upload
+@alru_cache(maxsize=64, ttl=5)
+async def fetch_admin_status(code: str) -> bool:
+    guest_group = await engine.get_collection(WeddingGuestGroup).find_one(
+        {"code": code}, {"admin": 1}
+    )
+    if not guest_group:
+        raise HTTPException(status_code=404, detail="Invalid user code, please login")
+    return guest_group["admin"]
+
+
 async def is_admin(code: str):
-    guest_group = await fetch_guest_group(code)
-    if not guest_group.admin:
+    if not await fetch_admin_status(code):
         raise HTTPException(
             status_code=403,
             detail="This action is only authorised for admins",
@@ -82,94 +160,80 @@ async def get_code(code: str):
 
 @app.get("/{code}/music")
 async def get_music(code: str) -> list[MusicResponse]:
-    await fetch_guest_group(code)
-    music = []
-    for grp in await engine.find(WeddingGuestGroup):
-        if grp.song_choice:
-            music.append(
-                MusicResponse(
-                    display_name=grp.display_name, song_choice=grp.song_choice
-                )
-            )
-    return music
+    await check_code_exists(code)
+    cursor = engine.get_collection(WeddingGuestGroup).find(
+        {"song_choice": {"$nin": [None, ""]}},
+        {"_id": 0, "display_name": 1, "song_choice": 1},
+    )
+    return [MusicResponse(**doc) async for doc in cursor]
 
 
 @app.get("/{code}/parking_count")
 async def get_parking_count(code: str) -> dict[str, int]:
-    await fetch_guest_group(code)
-    parking_count = sum(
-        [grp.parking_required for grp in await engine.find(WeddingGuestGroup)]
+    await check_code_exists(code)
+    parking_count = await engine.count(
+        WeddingGuestGroup, query.eq(WeddingGuestGroup.parking_required, True)
     )
     return {"parking_count": parking_count}
 
 
 @app.get("/admin/attendance")
 async def get_attendance() -> dict[str, int]:
-    party_count = sum([grp.party_total for grp in await engine.find(WeddingGuestGroup)])
-    ceremony_count = sum(
-        [grp.ceremony_total for grp in await engine.find(WeddingGuestGroup)]
+    attendance = await (
+        engine.get_collection(WeddingGuestGroup)
+        .aggregate(ATTENDANCE_PIPELINE)
+        .to_list(1)
     )
-    response_count = sum(
-        [grp.responded for grp in await engine.find(WeddingGuestGroup)]
-    )
-    total_grps = await engine.count(WeddingGuestGroup)
-    return {
-        "party_count": party_count,
-        "ceremony_count": ceremony_count,
-        "response_count": response_count,
-        "total_groups": total_grps,
-    }
+    if not attendance:
+        return {
+            "party_count": 0,
+            "ceremony_count": 0,
+            "response_count": 0,
+            "total_groups": 0,
+        }
+    return attendance[0]
 
 
 @app.post("/rsvp")
 async def rsvp(rsvp_data: RSVPRequest) -> WeddingGuestGroup:
-    grp = await fetch_guest_group(rsvp_data.code)
-    if rsvp_data.event == "party":
-        grp.party_attendance = rsvp_data.status
-    elif rsvp_data.event == "ceremony":
-        grp.ceremony_attendance = rsvp_data.status
-    else:
-        raise HTTPException(
-            status_code=400, detail="Invalid event. Must be party or ceremony."
-        )
-    await engine.save(grp)
-    return grp
+    return await update_guest_group(
+        rsvp_data.code,
+        [{"$set": {f"{rsvp_data.event}_attendance": rsvp_data.status}}, TOTALS_STAGE],
+    )
 
 
 @app.post("/plus-one")
 async def plus_one(plus_one_data: PlusOneRequest) -> WeddingGuestGroup:
-    grp = await fetch_guest_group(plus_one_data.code)
-    grp.plus_one = plus_one_data.status
-    await engine.save(grp)
-    return grp
+    return await update_guest_group(
+        plus_one_data.code, [{"$set": {"plus_one": plus_one_data.status}}, TOTALS_STAGE]
+    )
 
 
 @app.post("/songchoice")
 async def songchoice(songchoice_data: SongChoiceRequest) -> WeddingGuestGroup:
-    grp = await fetch_guest_group(songchoice_data.code)
-    grp.song_choice = songchoice_data.song_choice
-    await engine.save(grp)
-    return grp
+    return await update_guest_group(
+        songchoice_data.code, {"$set": {"song_choice": songchoice_data.song_choice}}
+    )
 
 
 @app.post("/dietary-requirements")
 async def dietary_requirements(
     dietary_requirements_data: DietaryRequirementsRequest,
 ) -> WeddingGuestGroup:
-    grp = await fetch_guest_group(dietary_requirements_data.code)
-    grp.dietary_requirements = dietary_requirements_data.requirements
-    await engine.save(grp)
-    return grp
+    return await update_guest_group(
+        dietary_requirements_data.code,
+        {"$set": {"dietary_requirements": dietary_requirements_data.requirements}},
+    )
 
 
 @app.post("/parking-required")
 async def parking_required(
     dietary_requirements_data: ParkingRequiredRequest,
 ) -> WeddingGuestGroup:
-    grp = await fetch_guest_group(dietary_requirements_data.code)
-    grp.parking_required = dietary_requirements_data.required
-    await engine.save(grp)
-    return grp
+    return await update_guest_group(
+        dietary_requirements_data.code,
+        {"$set": {"parking_required": dietary_requirements_data.required}},
+    )
 
 
 @app.post("/photo")
@@ -177,9 +241,15 @@ async def photo(code: str = Form(...), photos: list[UploadFile] = File(...)) ->
     await fetch_guest_group(code)
     try:
         bucket_name = config("AWS_BUCKET_NAME", default="s3://rjwedding")
-        s3 = boto3.client("s3")
+        await asyncio.gather(
+            *[
+                # UploadFile.read is awaitable, so the spooled file is read
+                # without blocking the event loop
+                app.state.s3.upload_fileobj(file, bucket_name, file.filename)
+                for file in photos
+            ]
+        )
         for file in photos:
-            s3.upload_fileobj(file.file, bucket_name, f"{file.filename}")
             logger.info(
                 f"{code} uploaded file {file.filename} to {bucket_name}/{file.filename}"
             )
@@ -189,47 +259,104 @@ async def photo(code: str = Form(...), photos: list[UploadFile] = File(...)) ->
     return {"message": "Photos uploaded!"}
 
 
+async def guest_groups_csv(chunk_size: int = 100) -> AsyncIterator[str]:
+    stream = io.StringIO()
+    writer = csv.writer(stream, lineterminator="\n")
+    writer.writerow(FIELDS)
+    rows = 0
+    cursor = engine.get_collection(WeddingGuestGroup).find({}).batch_size(500)
+    async for doc in cursor:
+        writer.writerow([doc.get(key) for key in DOC_KEYS])
+        rows += 1
+        if rows % chunk_size == 0:
+            yield stream.getvalue()
+            stream.seek(0)
+            stream.truncate()
+    if stream.tell():
+        yield stream.getvalue()
+
+
 @app.get("/{code}/download-database")
 async def download_database(code: str) -> StreamingResponse:
     await is_admin(code)
-    data = pd.concat(
-        [record.as_pandas() for record in await engine.find(WeddingGuestGroup)],
-        ignore_index=True,
+    return StreamingResponse(
+        guest_groups_csv(),
+        media_type="text/csv",
+        headers={
+            "Content-Disposition": f"attachment; filename=BurtonWeddingDatabase_{date.today()}.csv"
+        },
     )
-    stream = io.StringIO()
-    data.to_csv(stream, index=False)
-    response = StreamingResponse(iter([stream.getvalue()]), media_type="text/csv")
-    response.headers[
-        "Content-Disposition"
-    ] = f"attachment; filename=BurtonWeddingDatabase_{date.today()}.csv"
-    return response
 
 
-def database_validation(data: pd.DataFrame) -> pd.DataFrame:
-    for col in ["display_name", "party_count", "ceremony_count", "code"]:
-        if col not in data.columns:
+REQUIRED_COLUMNS = frozenset(["display_name", "party_count", "ceremony_count", "code"])
+
+
+def parse_count(value: str) -> int:
+    # Spreadsheet exports often write whole numbers as floats, e.g. 2.0
+    count = float(value)
+    if not count.is_integer():
+        raise ValueError(f"{value} is not a whole number")
+    return int(count)
+
+
+def database_validation(reader: csv.DictReader) -> list[dict[str, Any]]:
+    if not REQUIRED_COLUMNS.issubset(reader.fieldnames or []):
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid database format. Must contain the columns: Name, Guest count, Wedding party, and Code",
+        )
+    records = []
+    names = set()
+    codes = set()
+    for record in reader:
+        record["code"] = (record["code"] or "").replace(" ", "")
+        if record["display_name"] in names:
             raise HTTPException(
                 status_code=400,
-                detail="Invalid database format. Must contain the columns: Name, Guest count, Wedding party, and Code",
+                detail="Invalid database. Cannot contain duplicate names.",
             )
-    if data["display_name"].nunique() != data.shape[0]:
-        raise HTTPException(
-            status_code=400, detail="Invalid database. Cannot contain duplicate names."
-        )
-    if data["code"].nunique() != data.shape[0]:
-        raise HTTPException(
-            status_code=400, detail="Invalid database. Cannot contain duplicate codes."
-        )
-    if "Admin" not in data["display_name"].values:
+        if record["code"] in codes:
+            raise HTTPException(
+                status_code=400,
+                detail="Invalid database. Cannot contain duplicate codes.",
+            )
+        if any(value is None or value == "" for value in record.values()):
+            raise HTTPException(
+                status_code=400,
+                detail="Invalid database. Cannot contain null values.",
+            )
+        try:
+            record["party_count"] = parse_count(record["party_count"])
+            record["ceremony_count"] = parse_count(record["ceremony_count"])
+        except ValueError:
+            raise HTTPException(
+                status_code=400,
+                detail="Invalid database. Guest counts must be whole numbers.",
+            )
+        names.add(record["display_name"])
+        codes.add(record["code"])
+        records.append(record)
+    if "Admin" not in names:
         raise HTTPException(
             status_code=400, detail="Invalid database. Must contain an 'Admin'."
         )
-    if data.isnull().any().sum() > 0:
-        raise HTTPException(
-            status_code=400, detail="Invalid database. Cannot contain null values."
+    return records
+
+
+def parse_database(raw: bytes) -> list[WeddingGuestGroup]:
+    reader = csv.DictReader(io.StringIO(raw.decode("utf-8-sig")))
+    return [
+        # id has a default factory that mypy's pydantic signature doesn't see
+        WeddingGuestGroup(  # type: ignore[call-arg]
+            display_name=record["display_name"],
+            party_count=record["party_count"],
+            ceremony_count=record["ceremony_count"],
+            code=record["code"],
+            admin=record["display_name"] == "Admin",
+            is_couple="&" in record["display_name"],
         )
-    data["code"] = data["code"].apply(lambda x: str(x).replace(" ", ""))
-    return data
+        for record in database_validation(reader)
+    ]
 
 
 @app.post("/upload-database")
@@ -238,19 +365,15 @@ async def upload_database(
 ) -> dict:
     await is_admin(code)
     try:
-        df = database_validation(pd.read_csv(database_data.file))
+        raw = await database_data.read()
+        groups = await asyncio.to_thread(parse_database, raw)
         await engine.remove(WeddingGuestGroup)
-        new_ids = []
-        for index, row in df.iterrows():
-            grp = WeddingGuestGroup(
-                display_name=str(row["display_name"]),
-                party_count=int(row["party_count"]),
-                ceremony_count=int(row["ceremony_count"]),
-                code=str(row["code"].replace(" ", "")),
-                admin=str(row["display_name"]) == "Admin",
-            )
-            saved_grp = await engine.save(grp)
-            new_ids.append(saved_grp.id)
+        check_code_exists.cache_clear()
+        fetch_admin_status.cache_clear()
+        await engine.get_collection(WeddingGuestGroup).insert_many(
+            [grp.model_dump_doc() for grp in groups], ordered=False
+        )
+        new_ids = [str(grp.id) for grp in groups]
     except NoCredentialsError:
         logger.error("AWS credentials not available")
         raise HTTPException(status_code=500, detail="AWS credentials not available")
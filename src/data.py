@@ -1,10 +1,8 @@
-from typing import Optional
+from typing import Any, Literal, Optional
 
-import pandas as pd
 from fastapi import UploadFile
 from odmantic import Field, Model
-from pydantic import BaseModel
-from pydantic import Field as PydanticField
+from pydantic import BaseModel, ConfigDict
 
 
 class WeddingGuestGroup(Model):
@@ -22,55 +20,99 @@ class WeddingGuestGroup(Model):
     song_choice: Optional[str] = Field(default=None)
 
     admin: bool = Field(default=False)
+    is_couple: bool = Field(default=False)
     code: str = Field(unique=True)
     parking_required: bool = Field(default=False)
 
-    def as_pandas(self) -> pd.DataFrame:
-        return pd.DataFrame(self.dict(), index=[0])
-
-    @property
-    def party_total(self) -> int:
-        if self.party_attendance < 1:
-            return 0
-        if "&" not in self.display_name:
-            if self.plus_one:
-                return 2
-            return 1
-        return self.party_count
-
-    @property
-    def ceremony_total(self) -> int:
-        if self.ceremony_attendance < 1:
-            return 0
-        if "&" not in self.display_name:
-            if self.plus_one:
-                return 2
-            return 1
-        return self.ceremony_count
-
-    @property
-    def responded(self) -> int:
-        if self.ceremony_count > 0:
-            if self.ceremony_attendance == -1 and self.party_attendance == -1:
-                return 0
-            return 1
-        if self.party_attendance == -1:
-            return 0
-        return 1
+    party_total: int = Field(default=0)
+    ceremony_total: int = Field(default=0)
+
+
+FIELDS: tuple[str, ...] = tuple(WeddingGuestGroup.model_fields)
+# Raw document key for each field, e.g. "_id" for id
+DOC_KEYS: tuple[str, ...] = tuple(
+    WeddingGuestGroup.__odm_fields__[field].key_name for field in FIELDS
+)
+
+
+def event_total_expression(attendance: str, count: str) -> dict[str, Any]:
+    return {
+        "$cond": [
+            {"$lt": [f"${attendance}", 1]},
+            0,
+            {
+                "$cond": [
+                    "$is_couple",
+                    f"${count}",
+                    {"$cond": ["$plus_one", 2, 1]},
+                ]
+            },
+        ]
+    }
+
+
+IS_COUPLE_STAGE: dict[str, Any] = {
+    "$set": {"is_couple": {"$regexMatch": {"input": "$display_name", "regex": "&"}}}
+}
+
+TOTALS_STAGE: dict[str, Any] = {
+    "$set": {
+        "party_total": event_total_expression("party_attendance", "party_count"),
+        "ceremony_total": event_total_expression(
+            "ceremony_attendance", "ceremony_count"
+        ),
+    }
+}
+
+ATTENDANCE_PIPELINE: list[dict[str, Any]] = [
+    {
+        "$group": {
+            "_id": None,
+            "party_count": {"$sum": "$party_total"},
+            "ceremony_count": {"$sum": "$ceremony_total"},
+            "response_count": {
+                "$sum": {
+                    "$cond": [
+                        {
+                            "$or": [
+                                {"$ne": ["$party_attendance", -1]},
+                                {
+                                    "$and": [
+                                        {"$gt": ["$ceremony_count", 0]},
+                                        {"$ne": ["$ceremony_attendance", -1]},
+                                    ]
+                                },
+                            ]
+                        },
+                        1,
+                        0,
+                    ]
+                }
+            },
+            "total_groups": {"$sum": 1},
+        }
+    },
+    {"$project": {"_id": 0}},
+]
 
 
 class MusicResponse(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     display_name: str
     song_choice: str
 
 
 class RequestBase(BaseModel):
+    # Not extra="forbid": that would reject clients sending additional keys
+    model_config = ConfigDict(frozen=True)
+
     code: str
 
 
 class RSVPRequest(RequestBase):
     status: int
-    event: str = PydanticField(regex="^(party|ceremony)$")
+    event: Literal["party", "ceremony"]
 
 
 class PlusOneRequest(RequestBase):
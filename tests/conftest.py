@@ -1,15 +1,16 @@
 import asyncio
 import logging
+import socket
+from urllib.parse import urlsplit
 
-import docker
 import pytest
 from decouple import config
 from httpx import AsyncClient
 from odmantic import SyncEngine
 from pymongo import MongoClient
 
-from src.app import app
-from src.data import WeddingGuestGroup
+from src.app import app, check_code_exists, fetch_admin_status
+from src.data import TOTALS_STAGE, WeddingGuestGroup
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -33,23 +34,33 @@ async def client():
 
 
 def mongodb_testdb_container_check() -> bool:
-    for container in docker.from_env().containers.list():
-        if container.name == "rjwedding-mongodb":
+    uri = urlsplit(config("MONGO_URI", default="mongodb://localhost:27017/"))
+    try:
+        with socket.create_connection(
+            (uri.hostname or "localhost", uri.port or 27017), timeout=0.1
+        ):
             return True
-    return False
+    except OSError:
+        return False
 
 
 def clear_db(sync_engine: SyncEngine):
-    sync_engine.remove(WeddingGuestGroup)
-    assert len(list(sync_engine.find(WeddingGuestGroup))) == 0
+    collection = sync_engine.get_collection(WeddingGuestGroup)
+    collection.delete_many({})
+    assert collection.estimated_document_count() == 0
 
 
-@pytest.fixture
-def db_manager():
+@pytest.fixture(scope="session")
+def sync_engine():
     if not mongodb_testdb_container_check():
         raise ValueError("No mongodb test container found")
     client = MongoClient(config("MONGO_URI", default="mongodb://localhost:27017/"))
-    sync_engine = SyncEngine(client=client, database="test")
+    yield SyncEngine(client=client, database="test")
+    client.close()
+
+
+@pytest.fixture
+def db_manager(sync_engine: SyncEngine):
     clear_db(sync_engine)
     # Add 2 test WeddingGuestGroup documents
     test_grp1 = WeddingGuestGroup(
@@ -82,9 +93,14 @@ def db_manager():
         ceremony_attendance=1,
         admin=True,
     )
-    sync_engine.save(test_grp1)
-    sync_engine.save(test_grp2)
-    sync_engine.save(test_grp3)
-    sync_engine.save(admin)
+    collection = sync_engine.get_collection(WeddingGuestGroup)
+    collection.insert_many(
+        [grp.model_dump_doc() for grp in [test_grp1, test_grp2, test_grp3, admin]]
+    )
+    collection.update_many({}, [TOTALS_STAGE])
+    check_code_exists.cache_clear()
+    fetch_admin_status.cache_clear()
     yield
     clear_db(sync_engine)
+    check_code_exists.cache_clear()
+    fetch_admin_status.cache_clear()
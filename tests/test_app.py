@@ -1,9 +1,13 @@
 import io
+from datetime import date
 
 import pandas as pd
 import pytest
 from httpx import AsyncClient
 
+from src.app import backfill_derived_fields, guest_groups_csv
+from src.data import WeddingGuestGroup
+
 
 @pytest.mark.anyio
 async def test_healthy(client: AsyncClient):
@@ -32,8 +36,11 @@ async def test_get_code(client: AsyncClient, db_manager):
         "dietary_requirements": None,
         "song_choice": None,
         "admin": False,
+        "is_couple": False,
         "code": "test1",
         "parking_required": False,
+        "party_total": 0,
+        "ceremony_total": 0,
     }
 
 
@@ -43,6 +50,20 @@ async def test_get_code_404(client: AsyncClient, db_manager):
     assert response.status_code == 404
 
 
+@pytest.mark.anyio
+async def test_get_code_reflects_external_updates(
+    client: AsyncClient, db_manager, sync_engine
+):
+    response = await client.get("/test1")
+    assert response.json()["song_choice"] is None
+    # Simulate a write handled by another worker process
+    sync_engine.get_collection(WeddingGuestGroup).update_one(
+        {"code": "test1"}, {"$set": {"song_choice": "Another Song"}}
+    )
+    response = await client.get("/test1")
+    assert response.json()["song_choice"] == "Another Song"
+
+
 @pytest.mark.anyio
 async def test_get_music(client: AsyncClient, db_manager):
     response = await client.get("test1/music")
@@ -76,11 +97,32 @@ async def test_rsvp(client: AsyncClient, db_manager, event_type):
     )
     assert response.status_code == 200
     assert response.json()[f"{event_type}_attendance"] == 1
+    assert response.json()[f"{event_type}_total"] == 1
     response = await client.post(
         "/rsvp", json={"code": "test1", "status": 0, "event": event_type}
     )
     assert response.status_code == 200
     assert response.json()[f"{event_type}_attendance"] == 0
+    assert response.json()[f"{event_type}_total"] == 0
+
+
+@pytest.mark.anyio
+async def test_rsvp_couple(client: AsyncClient, db_manager, sync_engine):
+    couple = WeddingGuestGroup(
+        display_name="Alice & Bob",
+        party_count=2,
+        ceremony_count=0,
+        code="couple",
+        is_couple=True,
+    )
+    sync_engine.get_collection(WeddingGuestGroup).insert_one(couple.model_dump_doc())
+    response = await client.post(
+        "/rsvp", json={"code": "couple", "status": 1, "event": "party"}
+    )
+    assert response.status_code == 200
+    assert response.json()["party_total"] == 2
+    response = await client.get("/couple")
+    assert response.json()["party_total"] == 2
 
 
 @pytest.mark.anyio
@@ -122,11 +164,37 @@ async def test_get_attendance(client: AsyncClient, db_manager):
     response = await client.get("/admin/attendance")
     assert response.status_code == 200
     assert response.json() == {
-        "party_count": 0 + 2 + 1 + 2,
-        "ceremony_count": 0 + 2 + 0 + 2,
+        "party_count": 0 + 1 + 1 + 1,
+        "ceremony_count": 0 + 1 + 0 + 1,
+        "response_count": 3,
+        "total_groups": 4,
     }
 
 
+@pytest.mark.anyio
+async def test_backfill_derived_fields(db_manager, sync_engine):
+    collection = sync_engine.get_collection(WeddingGuestGroup)
+    legacy = WeddingGuestGroup(
+        display_name="Carol & Dave",
+        party_count=2,
+        ceremony_count=2,
+        party_attendance=1,
+        ceremony_attendance=0,
+        code="legacy",
+    ).model_dump_doc()
+    for key in ("is_couple", "party_total", "ceremony_total"):
+        legacy.pop(key)
+    collection.insert_one(legacy)
+    # Documents that already have the derived fields are left alone
+    collection.update_one({"code": "test2"}, {"$set": {"party_total": 99}})
+    await backfill_derived_fields()
+    doc = collection.find_one({"code": "legacy"})
+    assert doc["is_couple"] is True
+    assert doc["party_total"] == 2
+    assert doc["ceremony_total"] == 0
+    assert collection.find_one({"code": "test2"})["party_total"] == 99
+
+
 @pytest.mark.anyio
 async def test_plus_one(client: AsyncClient, db_manager):
     response = await client.post("/plus-one", json={"code": "test3", "status": 1})
@@ -139,10 +207,21 @@ async def test_download_database(client: AsyncClient, db_manager):
     response = await client.get("/admin/download-database")
     assert response.status_code == 200
     assert (
-        response.headers["Content-Disposition"] == "attachment; filename=database.csv"
+        response.headers["Content-Disposition"]
+        == f"attachment; filename=BurtonWeddingDatabase_{date.today()}.csv"
     )
     data = pd.read_csv(io.StringIO(response.text))
-    assert data.shape == (4, 16)
+    assert data.shape == (4, 19)
+
+
+@pytest.mark.anyio
+async def test_guest_groups_csv_chunks(db_manager):
+    # 4 rows split evenly into chunks of 2 must not end with an empty chunk
+    chunks = [chunk async for chunk in guest_groups_csv(chunk_size=2)]
+    assert len(chunks) == 2
+    assert all(chunks)
+    data = pd.read_csv(io.StringIO("".join(chunks)))
+    assert data.shape == (4, 19)
 
 
 @pytest.mark.anyio
@@ -195,6 +274,8 @@ async def test_upload_database(client: AsyncClient, db_manager):
     assert response.json() == {
         "ceremony_count": 0,
         "party_count": 0,
+        "response_count": 0,
+        "total_groups": 2,
     }
 
 
@@ -276,6 +357,87 @@ async def test_upload_database_duplicate_codes(client: AsyncClient, db_manager):
     assert response.status_code == 400
 
 
+@pytest.mark.anyio
+async def test_upload_database_float_counts(client: AsyncClient, db_manager):
+    raw = (
+        "display_name,code,party_count,ceremony_count\n"
+        "Test Group 3,test3,3.0,0.0\n"
+        "Admin,admin,2,2\n"
+    )
+    response = await client.post(
+        "/upload-database",
+        data={"code": "admin"},
+        files={"database_data": raw.encode("utf-8")},
+    )
+    assert response.status_code == 200
+    response = await client.get("/test3")
+    assert response.json()["party_count"] == 3
+    assert response.json()["ceremony_count"] == 0
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("count", ["two", "2.5"])
+async def test_upload_database_invalid_counts(client: AsyncClient, db_manager, count):
+    raw = (
+        "display_name,code,party_count,ceremony_count\n"
+        f"Test Group 3,test3,{count},0\n"
+        "Admin,admin,2,2\n"
+    )
+    response = await client.post(
+        "/upload-database",
+        data={"code": "admin"},
+        files={"database_data": raw.encode("utf-8")},
+    )
+    assert response.status_code == 400
+    assert (
+        response.json()["detail"]
+        == "Invalid database. Guest counts must be whole numbers."
+    )
+    response = await client.get("/test1")
+    assert response.status_code == 200
+
+
+@pytest.mark.anyio
+async def test_upload_database_duplicate_codes_after_stripping_spaces(
+    client: AsyncClient, db_manager
+):
+    new_data = pd.DataFrame(
+        [
+            {
+                "display_name": "Test Group 2",
+                "code": "ab c",
+                "party_count": 3,
+                "ceremony_count": 0,
+            },
+            {
+                "display_name": "Test Group 3",
+                "code": "abc",
+                "party_count": 3,
+                "ceremony_count": 0,
+            },
+            {
+                "display_name": "Admin",
+                "code": "admin",
+                "party_count": 2,
+                "ceremony_count": 2,
+            },
+        ]
+    )
+    response = await client.post(
+        "/upload-database",
+        data={"code": "admin"},
+        files={"database_data": bytes(new_data.to_csv(index=False), encoding="utf-8")},
+    )
+    assert response.status_code == 400
+    assert (
+        response.json()["detail"] == "Invalid database. Cannot contain duplicate codes."
+    )
+    response = await client.get("/test1")
+    assert response.status_code == 200
+    response = await client.get("/abc")
+    assert response.status_code == 404
+
+
 @pytest.mark.anyio
 async def test_upload_database_no_admin(client: AsyncClient, db_manager):
     new_data = pd.DataFrame(